@@ -9,6 +9,8 @@ from UM.Settings.SettingDefinition import SettingDefinition
 from UM.Settings.DefinitionContainer import DefinitionContainer
 from UM.Settings.ContainerRegistry import ContainerRegistry
 from UM.Logger import Logger
+from UM.Message import Message
+from UM.Resources import Resources
 
 from math import sqrt
 from . import ScalableExtraPrimeAdjuster
@@ -90,6 +92,44 @@ class ScalableExtraPrime(Extension):
             "settable_per_extruder": False,
             "settable_per_meshgroup": False,
         }
+        self._time_budget_key = "scalable_prime_time_budget"
+        self._time_budget_dict = {
+            "label": "Extra Prime Time Limit",
+            "description": "Maximum time spent adding extra prime to a plate when saving. If it takes longer, the plate is saved without extra prime and a warning is shown",
+            "type": "float",
+            "unit": "s",
+            "default_value": ScalableExtraPrimeAdjuster.DEFAULT_TIME_BUDGET,
+            "minimum_value": 1,
+            "enabled": "scalable_prime_enable",
+            "settable_per_mesh": False,
+            "settable_per_extruder": False,
+            "settable_per_meshgroup": False
+        }
+        self._memory_budget_key = "scalable_prime_memory_budget"
+        self._memory_budget_dict = {
+            "label": "Extra Prime Memory Limit",
+            "description": "Maximum memory used to add extra prime to a plate when saving. If it needs more, the plate is saved without extra prime and a warning is shown",
+            "type": "int",
+            "unit": "MB",
+            "default_value": ScalableExtraPrimeAdjuster.DEFAULT_MEMORY_BUDGET // (1024 * 1024),
+            "minimum_value": 64,
+            "enabled": "scalable_prime_enable",
+            "settable_per_mesh": False,
+            "settable_per_extruder": False,
+            "settable_per_meshgroup": False
+        }
+        self._sidecar_cache_key = "scalable_prime_sidecar_cache"
+        self._sidecar_cache_dict = {
+            "label": "Extra Prime Sidecar Cache",
+            "description": "Keeps where extra prime can be added for recently sliced gcode, so saving a re-slice of the same model with different extra prime settings is faster. Uses up to 256MB in Cura's data folder",
+            "type": "bool",
+            "unit": "",
+            "default_value": False,
+            "enabled": "scalable_prime_enable",
+            "settable_per_mesh": False,
+            "settable_per_extruder": False,
+            "settable_per_meshgroup": False
+        }
         self._setting_key = "scalable_prime_enable"
         self._setting_dict = {
             "label": "Enable Scalable Extra Prime",
@@ -125,6 +165,9 @@ class ScalableExtraPrime(Extension):
         self.create_and_attach_setting(container, self._min_prime_key, self._min_prime_dict, self._setting_key)
         self.create_and_attach_setting(container, self._max_prime_key, self._max_prime_dict, self._setting_key)
         self.create_and_attach_setting(container, self._enable_all_travels_key, self._enable_all_travels_dict, self._setting_key)
+        self.create_and_attach_setting(container, self._time_budget_key, self._time_budget_dict, self._setting_key)
+        self.create_and_attach_setting(container, self._memory_budget_key, self._memory_budget_dict, self._setting_key)
+        self.create_and_attach_setting(container, self._sidecar_cache_key, self._sidecar_cache_dict, self._setting_key)
 
     def _onGlobalContainerStackChanged(self):
         self._global_container_stack = self._application.getGlobalContainerStack()
@@ -142,6 +185,9 @@ class ScalableExtraPrime(Extension):
         min_prime = self._global_container_stack.getProperty(self._min_prime_key, "value")
         max_prime = self._global_container_stack.getProperty(self._max_prime_key, "value")
         extra_prime_without_retraction = self._global_container_stack.getProperty(self._enable_all_travels_key, "value")
+        time_budget = self._global_container_stack.getProperty(self._time_budget_key, "value")
+        memory_budget = self._global_container_stack.getProperty(self._memory_budget_key, "value") * 1024 * 1024
+        sidecar_cache = self._global_container_stack.getProperty(self._sidecar_cache_key, "value")
 
         gcode_dict = getattr(scene, "gcode_dict", {})
         if not gcode_dict:  # this also checks for an empty dict
@@ -158,7 +204,16 @@ class ScalableExtraPrime(Extension):
                     Logger.log("e", "Scalable Extra Prime not supported in relative extrusion mode")
                     return
             if ";EOFFSETPROCESSED" not in gcode_list[0]:
-                gcode_list = ScalableExtraPrimeAdjuster.parse_and_adjust_gcode(gcode_list, min_travel, max_travel, min_prime, max_prime, extra_prime_without_retraction)
+                budget = ScalableExtraPrimeAdjuster.Budget(time_budget, memory_budget)
+                # A sidecar lets a re-slice of the same model skip scanning the gcode
+                index_directory = os.path.join(Resources.getDataStoragePath(), "scalable_prime_index") if sidecar_cache else None
+                # Spawned worker processes would start Cura again, so the plugin always uses the serial engine
+                gcode_list, warning = ScalableExtraPrimeAdjuster.adjust_gcode(gcode_list, min_travel, max_travel, min_prime, max_prime, extra_prime_without_retraction, None, budget, index_directory)
+                if warning:
+                    Logger.log("w", "Scalable Extra Prime skipped plate %s: %s", plate_id, warning)
+                    Message(i18n_catalog.i18nc("@info:status", "Extra prime was not added to plate {0}: {1}").format(plate_id, warning),
+                            title=i18n_catalog.i18nc("@info:title", "Scalable Extra Prime")).show()
+                    continue
 
                 gcode_list[0] += ";EOFFSETPROCESSED\n"
                 gcode_dict[plate_id] = gcode_list
@@ -1,130 +1,844 @@
 # Copyright (c) 2018 Pheneeny
 # The ScalableExtraPrime plugin is released under the terms of the AGPLv3 or higher.
 
+import hashlib
+import itertools
+import json
+import mmap
+import multiprocessing
+import os
+import platform
+import struct
+import sys
+import time
+
 from math import sqrt
-from collections import namedtuple
+from array import array
+from collections import namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from pickle import PicklingError
 
 Point = namedtuple('Point', 'x y')
 GCodeArg = namedtuple('GCodeArg', 'name value')
+PrimeSite = namedtuple('PrimeSite', 'kind layer line_start e_start e_end line_end travel retraction has_point e template')
+
+EVENT_RESET = 0
+EVENT_TRAVEL = 1
+EVENT_MOVE = 2
+EVENT_EXTRUDE = 3
+
+ENGINE_SERIAL = "serial"
+ENGINE_PARALLEL = "parallel"
+
+EngineChoice = namedtuple('EngineChoice', 'engine workers reason estimated_seconds')
+Calibration = namedtuple('Calibration', 'scan_seconds_per_byte fold_seconds_per_byte pool_startup_seconds pool_seconds_per_byte')
+
+# Jobs smaller than this always run serially, so they don't pay for starting a process pool
+MIN_PARALLEL_BYTES = 4 * 1024 * 1024
+# Layers are sent to pool workers in chunks of about this size, with a few chunks per worker in flight at a time
+POOL_CHUNK_BYTES = 256 * 1024
+POOL_CHUNKS_PER_WORKER = 2
+
+DEFAULT_TIME_BUDGET = 60
+DEFAULT_MEMORY_BUDGET = 1024 * 1024 * 1024
+# Measured allocations: scanned events per byte of gcode in flight, and bytes per patch including its share of texts
+SCAN_MEMORY_PER_BYTE = 14
+PATCH_MEMORY = 36
+# Measured allocations per piece while a patched layer is joined
+PIECE_MEMORY = 60
+
+CALIBRATION_VERSION = 2
+CALIBRATION_LAYERS = 8
+CALIBRATION_LAYER_LINES = 500
+CALIBRATION_TIMEOUT = 10
+CALIBRATION_WORKERS = 2
+# Each warm-up task keeps its worker busy this long, so every worker of the pool is started
+CALIBRATION_WARM_UP_SECONDS = 0.1
+
+_calibration = None
+
+PRIME_INDEX_MAGIC = b"SEPIDX03"
+PRIME_INDEX_SUFFIX = ".idx"
+# Total size of the sidecars kept in an index directory, the least recently used are removed first
+PRIME_INDEX_MAX_BYTES = 256 * 1024 * 1024
+# Temporary files older than this are left over from an interrupted write
+PRIME_INDEX_STALE_SECONDS = 60 * 60
+# magic, sha256 of the gcode, number of records
+PRIME_INDEX_HEADER = struct.Struct("<8s32sQ")
+# flags, layer, line start, line end, offset of the E value in the line and its length, travel distance, original e
+PRIME_INDEX_RECORD = struct.Struct("<BIIIHBdd")
+PRIME_INDEX_RESET = 1
+PRIME_INDEX_RETRACTION = 2
+PRIME_INDEX_HAS_POINT = 4
+# The line has no single E value to rewrite, and is tokenized again when the index is read
+PRIME_INDEX_TEMPLATE = 8
+
+# Stands in for the E value in a line template until the adjusted value is known. Templates are only made for lines
+# that combine_gcode would not give back unchanged, for all other lines just the E value is rewritten
+E_PLACEHOLDER = "\0"
+
+
+class GCodePatchList:
+    """Compact list of text replacements produced by the adjuster.
+
+    Patch n replaces the characters starts[n]:ends[n] of gcode layer layers[n]. Most patches only rewrite an E value,
+    which is kept as a number in values[n] and formatted when the patch is applied. The few other patches keep their
+    replacement text in texts[n]. Patches are kept in layer order, and in order of position within a layer, so they can
+    be applied in a single pass.
+    """
+    def __init__(self):
+        self.layers = array('i')
+        self.starts = array('i')
+        self.ends = array('i')
+        self.values = array('d')
+        self.texts = {}
+
+    def append(self, layer:int, start:int, end:int, replacement:str):
+        self.texts[len(self.values)] = replacement
+        self.append_value(layer, start, end, 0)
+
+    def append_value(self, layer:int, start:int, end:int, value:float):
+        self.layers.append(layer)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.values.append(value)
+
+    def get_replacement(self, patch_nr:int)->str:
+        text = self.texts.get(patch_nr)
+        if text is None:
+            return str(self.values[patch_nr])
+        return text
+
+    def __len__(self):
+        return len(self.values)
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class Budget:
+    """Upper bounds on the time (in seconds) and memory (in bytes) the adjuster may use. A bound of None is unlimited.
+
+    The clock starts when the budget is created, so create it before selecting an engine to include calibration. Memory
+    is what the adjuster allocates on top of the gcode it is given: the scans of the layers in flight, the patches,
+    the prime index records and the output layers. Each of these parts reports its current size with set_memory.
+    """
+    def __init__(self, seconds:float=None, memory:int=None):
+        self.seconds = seconds
+        self.deadline = None if seconds is None else time.perf_counter() + seconds
+        self.memory = memory
+        self._memory_parts = {}
+
+    def remaining(self)->float:
+        if self.deadline is None:
+            return None
+        return max(0, self.deadline - time.perf_counter())
+
+    def set_memory(self, part:str, size:int):
+        self._memory_parts[part] = size
+
+    def get_memory(self)->int:
+        return sum(self._memory_parts.values())
+
+    def check(self):
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            raise BudgetExceeded("time budget of {}s exceeded".format(self.seconds))
+        if self.memory is not None and self.get_memory() > self.memory:
+            raise BudgetExceeded("memory budget of {} bytes exceeded".format(self.memory))
+
+
+def adjust_gcode(gcode_layers:[str], min_travel:float, max_travel:float, min_prime:float, max_prime:float, extra_prime_without_retraction:bool=True, engine:EngineChoice=None, budget:Budget=None, index_directory:str=None, parallel:bool=False)->([str], str):
+    # Never modifies gcode_layers. Returns a new list of layers, sharing every layer that didn't change, and None. If the
+    # budget is exceeded or processing fails, returns gcode_layers untouched and a warning, so output is never half processed
+    # If index_directory is given, the prime sites are read from the sidecar written there for exactly this gcode, which
+    # gives the same output as scanning it. Otherwise the gcode is scanned, and a sidecar for it is written unless the
+    # budget has run out by then
+    # If engine is None, select_engine picks one only once the gcode has to be scanned, considering the parallel engine
+    # if parallel is True. Estimates only choose the engine, the budget is enforced while the work is done
+    if budget is None:
+        budget = Budget(DEFAULT_TIME_BUDGET, DEFAULT_MEMORY_BUDGET)
+
+    input_hash = None
+    input_records = None
+    try:
+        prime_index = None
+        if index_directory is not None:
+            input_hash = get_gcode_hash(gcode_layers, budget)
+            prime_index = load_prime_index(get_prime_index_path(index_directory, input_hash), gcode_layers, input_hash)
+        if prime_index is not None:
+            with prime_index:
+                patches = get_patches_from_sites(gcode_layers, prime_index, min_travel, max_travel, min_prime, max_prime, extra_prime_without_retraction, budget)
+        else:
+            if engine is None:
+                engine = select_engine(gcode_layers, budget=budget, parallel=parallel)
+            input_records = None if index_directory is None else bytearray()
+            try:
+                patches = get_gcode_patches(gcode_layers, min_travel, max_travel, min_prime, max_prime, extra_prime_without_retraction, engine.workers, budget, input_records)
+            except (BrokenProcessPool, PicklingError, OSError):
+                if engine.workers <= 1:
+                    raise
+                # The process pool failed, carry on with the serial engine in the time that is left
+                if input_records is not None:
+                    input_records = bytearray()
+                patches = get_gcode_patches(gcode_layers, min_travel, max_travel, min_prime, max_prime, extra_prime_without_retraction, 1, budget, input_records)
+        output_layers = apply_gcode_patches(list(gcode_layers), patches, budget)
+    except BudgetExceeded as e:
+        return gcode_layers, "{}, gcode was left unchanged".format(e)
+    except Exception as e:
+        return gcode_layers, "processing failed ({}), gcode was left unchanged".format(e)
+
+    if input_records is not None:
+        try:
+            # The sidecar only saves work next time, the output is still complete without it
+            budget.check()
+            os.makedirs(index_directory, exist_ok=True)
+            save_prime_index(get_prime_index_path(index_directory, input_hash), input_hash, input_records)
+            prune_prime_indexes(index_directory)
+        except (OSError, BudgetExceeded):
+            pass
+    return output_layers, None
+
+
+def parse_and_adjust_gcode(gcode_layers:[[str]], min_travel:float, max_travel:float, min_prime:float, max_prime:float, extra_prime_without_retraction:bool=True, workers:int=1)->([str], float):
+    patches = get_gcode_patches(gcode_layers, min_travel, max_travel, min_prime, max_prime, extra_prime_without_retraction, workers)
+    return apply_gcode_patches(gcode_layers, patches)
+
+
+def get_gcode_patches(gcode_layers:[str], min_travel:float, max_travel:float, min_prime:float, max_prime:float, extra_prime_without_retraction:bool=True, workers:int=1, budget:Budget=None, input_records:bytearray=None)->GCodePatchList:
+    # gcode_list[2] is the first layer, after the preamble and the start gcode. Skip the last layer
+    processed_layers = range(2, len(gcode_layers) - 1)
+
+    if workers > 1 and len(processed_layers) > 1:
+        scans = scan_gcode_layers_in_pool(gcode_layers, processed_layers, workers, budget)
+    else:
+        scans = iterate_scans(gcode_layers, processed_layers, budget)
+
+    try:
+        return get_patches_from_scans(gcode_layers, scans, min_travel, max_travel, min_prime, max_prime, extra_prime_without_retraction, budget, input_records)
+    finally:
+        scans.close()
+
+
+def iterate_scans(gcode_layers:[str], processed_layers:range, budget:Budget=None):
+    # Yields (layer, events) in layer order
+    previous_bytes = 0
+    for layer in processed_layers:
+        if budget is not None:
+            # The previous layer's scan is still held by the fold while this one is built
+            budget.set_memory("scans", (previous_bytes + len(gcode_layers[layer])) * SCAN_MEMORY_PER_BYTE)
+            budget.check()
+            previous_bytes = len(gcode_layers[layer])
+        yield layer, scan_gcode_layer(gcode_layers[layer])
+
+
+def scan_gcode_layers(layer_texts:[str])->[[tuple]]:
+    return [scan_gcode_layer(gcode_layer) for gcode_layer in layer_texts]
+
+
+def scan_gcode_layers_in_pool(gcode_layers:[str], processed_layers:range, workers:int, budget:Budget=None):
+    # Yields (layer, events) in layer order, as soon as the chunk holding the layer is scanned. Only a few chunks per
+    # worker are in flight at a time, so scans don't pile up in this process while they are folded
+    chunks = iter(get_layer_chunks(gcode_layers, processed_layers))
+    executor = create_process_pool(workers)
+    pending = deque()
+    previous_chunk = range(0)
+    try:
+        for chunk in itertools.islice(chunks, workers * POOL_CHUNKS_PER_WORKER):
+            pending.append((chunk, executor.submit(scan_gcode_layers, [gcode_layers[layer] for layer in chunk])))
+
+        while pending:
+            chunk, future = pending.popleft()
+            try:
+                scans = future.result(timeout=None if budget is None else budget.remaining())
+            except TimeoutError:
+                raise BudgetExceeded("time budget of {}s exceeded".format(budget.seconds))
+
+            next_chunk = next(chunks, None)
+            if next_chunk is not None:
+                pending.append((next_chunk, executor.submit(scan_gcode_layers, [gcode_layers[layer] for layer in next_chunk])))
+
+            if budget is not None:
+                # The chunk being folded, the previous one still held while this one arrived, and every chunk that
+                # may have arrived already
+                chunks_in_flight = [previous_chunk, chunk] + [pending_chunk for pending_chunk, _ in pending]
+                bytes_in_flight = sum(len(gcode_layers[layer]) for chunk_in_flight in chunks_in_flight for layer in chunk_in_flight)
+                budget.set_memory("scans", bytes_in_flight * SCAN_MEMORY_PER_BYTE)
+                budget.check()
+            previous_chunk = chunk
+            yield from zip(chunk, scans)
+    finally:
+        shutdown_process_pool(executor, [future for _, future in pending])
+
+
+def get_layer_chunks(gcode_layers:[str], processed_layers:range)->[range]:
+    chunks = []
+    chunk_start = processed_layers.start
+    chunk_bytes = 0
+    for layer in processed_layers:
+        chunk_bytes += len(gcode_layers[layer])
+        if chunk_bytes >= POOL_CHUNK_BYTES:
+            chunks.append(range(chunk_start, layer + 1))
+            chunk_start = layer + 1
+            chunk_bytes = 0
+    if chunk_start < processed_layers.stop:
+        chunks.append(range(chunk_start, processed_layers.stop))
+    return chunks
+
+
+def create_process_pool(workers:int)->ProcessPoolExecutor:
+    # Spawn rather than fork, a forked copy of a threaded process such as Cura can deadlock
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def shutdown_process_pool(executor:ProcessPoolExecutor, futures:list):
+    # Don't wait for workers that are still busy when giving up
+    if sys.version_info >= (3, 9):
+        executor.shutdown(wait=False, cancel_futures=True)
+    else:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def scan_gcode_layer(gcode_layer:str)->[tuple]:
+    # Tokenizes a single layer into the events that matter for extra prime. This does not depend on any state carried
+    # over from other layers, so layers can be scanned in any order, or in other processes.
+    events = []
+
+    line_end = -1
+    for line in gcode_layer.split("\n"):
+        line_start = line_end + 1
+        line_end = line_start + len(line)
+
+        # Check if line is empty or a comment
+        if len(line.strip()) == 0 or line.strip()[0] == ';':
+            continue
+
+        split_g = split_canonical_gcode(line)
+        canonical = split_g is not None
+        if not canonical:
+            split_g = split_gcode(line)
+        command, command_value = split_g[0]
+
+        # Handle movement command
+        if command == 'G':
+            #Handle resetting E position
+            if command_value == '92':
+                e_val = get_e_from_split(split_g)
+                if e_val is not None:
+                    events.append((EVENT_RESET, e_val))
+            # Handle travel
+            elif command_value == '0':
+                current_point = get_point_from_split(split_g)
+                if current_point is not None:
+                    events.append((EVENT_TRAVEL, current_point))
+
+            # Handle extrude
+            elif command_value == '1':
+                current_point = get_point_from_split(split_g)
+                current_e = get_e_from_split(split_g)
+
+                #No extrusion on this G1?
+                if current_e is None:
+                    if current_point is not None:
+                        events.append((EVENT_MOVE, current_point))
+                    continue
+
+                if canonical:
+                    e_start = line.find(" E") + 2
+                    e_end = line.find(" ", e_start)
+                    if e_end == -1:
+                        e_end = len(line)
+                    #Lines with more than one E argument get all of them replaced, leave those to a template
+                    if line.find(" E", e_end) == -1:
+                        events.append((EVENT_EXTRUDE, current_point, current_e, line_start, line_start + e_start, line_start + e_end, line_end, None))
+                        continue
+
+                events.append((EVENT_EXTRUDE, current_point, current_e, line_start, line_start, line_start, line_end, get_template_from_split(split_gcode(line))))
+        elif command == 'M':
+            if command_value == '83':
+                raise Exception("M83 found, plugin does not support relative extrusion")
+    return events
 
 
-def parse_and_adjust_gcode(gcode_layers:[[str]], min_travel:float, max_travel:float, min_prime:float, max_prime:float, extra_prime_without_retraction:bool=True)->([str], float):
+def get_patches_from_scans(gcode_layers:[str], scans, min_travel:float, max_travel:float, min_prime:float, max_prime:float, extra_prime_without_retraction:bool=True, budget:Budget=None, input_records:bytearray=None)->GCodePatchList:
+    return get_patches_from_sites(gcode_layers, get_prime_sites(scans), min_travel, max_travel, min_prime, max_prime, extra_prime_without_retraction, budget, input_records)
 
+
+def get_prime_sites(scans):
+    # Walks the (layer, events) pairs produced by scan_gcode_layer in layer order, and yields a site for every extrusion
+    # and E reset, as a plain tuple with the fields of PrimeSite. Everything a site records is independent of the prime
+    # settings.
     last_point = None
 
     last_e = 0
-    adjusted_e = 0
 
     current_travel = 0
     current_retraction = 0
 
-    if min_travel > max_travel:
-        min_travel, max_travel = max_travel, min_travel
-
-    if min_prime > max_prime:
-        min_prime, max_prime = max_prime, min_prime
-
-    num_layers = len(gcode_layers)
-    for layer, gcode_layer in enumerate(gcode_layers):
-        # gcode_list[2] is the first layer, after the preamble and the start gcode
-        if layer < 2:
-            continue
+    for layer, events in scans:
+        for event in events:
+            event_type = event[0]
 
-        # Skip the last layer
-        if layer >= num_layers - 1:
-            continue
+            if event_type == EVENT_RESET:
+                last_e = event[1]
+                yield (EVENT_RESET, layer, 0, 0, 0, 0, 0, False, False, last_e, None)
 
-        lines = gcode_layer.split("\n");
-        for (line_nr, line) in enumerate(lines):
+            elif event_type == EVENT_TRAVEL:
+                current_point = event[1]
+                if last_point is None:
+                    last_point = current_point
+                current_travel += get_distance(last_point, current_point)
+                last_point = current_point
 
-            # Check if line is empty or a comment
-            if len(line.strip()) == 0 or line.strip()[0] == ';':
-                continue
+            elif event_type == EVENT_MOVE:
+                last_point = event[1]
 
-            split_g = split_gcode(line)
-            command, command_value = split_g[0]
-
-            # Handle movement command
-            if command == 'G':
-                #Handle resetting E position
-                if command_value == '92':
-                    e_val = get_e_from_split(split_g)
-                    if e_val is not None:
-                        last_e = e_val
-                        adjusted_e = e_val
-                        continue
-                # Handle travel
-                if command_value == '0':
-                    current_point = get_point_from_split(split_g)
-                    if current_point is None:
-                        continue
-                    if last_point is None:
-                        last_point = current_point
-                    current_travel += get_distance(last_point, current_point)
+            else:
+                _, current_point, current_e, line_start, e_start, e_end, line_end, template = event
+                if current_point is not None:
                     last_point = current_point
 
-                # Handle extrude
-                elif command_value == '1':
-                    current_point = get_point_from_split(split_g)
-                    if last_point is None:
-                        last_point = current_point
-                    current_e = get_e_from_split(split_g)
-                    if current_point is not None:
-                        last_point = current_point
+                yield (EVENT_EXTRUDE, layer, line_start, e_start, e_end, line_end, current_travel, current_retraction != 0, current_point is not None, current_e, template)
 
-                    #No extrusion on this G1?
-                    if current_e is None:
-                        continue
+                e_diff = current_e - last_e
+                current_travel = 0
+                if e_diff < 0:
+                    current_retraction = e_diff
+                else:
+                    current_retraction = 0
 
+                last_e = current_e
 
-                    e_diff = current_e - last_e
 
-                    adjustment_message = None
-                    extra_move = None
+def get_patches_from_sites(gcode_layers:[str], sites, min_travel:float, max_travel:float, min_prime:float, max_prime:float, extra_prime_without_retraction:bool=True, budget:Budget=None, input_records:bytearray=None)->GCodePatchList:
+    # Applies the prime settings to the sites, and creates patches for everything that changes. If input_records is
+    # given, prime index records for the sites are appended to it.
+    patches = GCodePatchList()
+    append_patch = patches.append
+    append_value_patch = patches.append_value
+
+    last_e = 0
+    adjusted_e = 0
 
-                    #Check if this is the first extrude after a travel
-                    if current_travel != 0 and (current_retraction != 0 or extra_prime_without_retraction):
-                        #Calculate extra prime based on travel distance
-                        extra_e = round(get_extra_e(min_travel, max_travel, min_prime, max_prime, current_travel), 5)
-                        adjusted_e += extra_e;
+    current_layer = None
+    gcode_layer = None
 
-                        if extra_e != 0:
-                            adjustment_message = "Adjusted e by {}mm".format(extra_e);
+    if min_travel > max_travel:
+        min_travel, max_travel = max_travel, min_travel
 
-                            #If this move wasn't a prime after a retraction, create a move that we will inject later
-                            if current_retraction == 0 and get_point_from_split(split_g) is not None:
-                                extra_move = "G1 E{} ;{}\n".format(round(adjusted_e, 5), adjustment_message)
-                                adjustment_message = None
+    if min_prime > max_prime:
+        min_prime, max_prime = max_prime, min_prime
 
-                    #Adjust for current move extrusion
-                    adjusted_e += e_diff
+    for kind, layer, line_start, e_start, e_end, line_end, travel, retraction, has_point, e, template in sites:
+        if layer != current_layer:
+            if budget is not None:
+                budget.set_memory("patches", len(patches) * PATCH_MEMORY)
+                budget.set_memory("index", len(input_records or b""))
+                budget.check()
+            current_layer = layer
+            gcode_layer = gcode_layers[layer]
+
+        if kind == EVENT_RESET:
+            last_e = e
+            adjusted_e = e
+            if input_records is not None:
+                input_records += PRIME_INDEX_RECORD.pack(PRIME_INDEX_RESET, layer, 0, 0, 0, 0, 0, e)
+            continue
 
-                    #Set adjusted value for the current move
-                    set_e_in_split(split_g, adjusted_e)
+        e_diff = e - last_e
 
-                    #Generate new gcode
-                    new_gcode = combine_gcode(split_g, adjustment_message);
+        adjustment_message = None
+        extra_move = None
 
-                    #If we created an extra move before, prepend it to the generated gcode
-                    if extra_move:
-                        new_gcode = extra_move + new_gcode
+        #Check if this is the first extrude after a travel
+        if travel != 0 and (retraction or extra_prime_without_retraction):
+            #Calculate extra prime based on travel distance
+            extra_e = round(get_extra_e(min_travel, max_travel, min_prime, max_prime, travel), 5)
+            adjusted_e += extra_e;
 
-                    lines[line_nr] = new_gcode
+            if extra_e != 0:
+                adjustment_message = "Adjusted e by {}mm".format(extra_e);
 
-                    current_travel = 0
-                    if e_diff < 0:
-                        current_retraction = e_diff
-                    else:
-                        current_retraction = 0
+                #If this move wasn't a prime after a retraction, create a move that we will inject later
+                if not retraction and has_point:
+                    extra_move = "G1 E{} ;{}\n".format(round(adjusted_e, 5), adjustment_message)
+                    adjustment_message = None
 
-                    last_e = current_e
-            elif command == 'M':
-                if command_value == '83':
-                    raise Exception("M83 found, plugin does not support relative extrusion")
-        gcode_layers[layer] = "\n".join(lines)
+        #Adjust for current move extrusion
+        adjusted_e += e_diff
+
+        if template is None:
+            #Only the E value of the line is rewritten. The extra move goes in front of the line, the comment after it
+            if extra_move:
+                append_patch(layer, line_start, line_start, extra_move)
+            e_value = round(adjusted_e, 5)
+            if str(e_value) != gcode_layer[e_start:e_end]:
+                append_value_patch(layer, e_start, e_end, e_value)
+            if adjustment_message:
+                append_patch(layer, line_end, line_end, " ;" + adjustment_message)
+        else:
+            #Generate new gcode with the adjusted value for the current move
+            new_gcode = combine_template(template, adjusted_e, adjustment_message)
+
+            #If we created an extra move before, prepend it to the generated gcode
+            if extra_move:
+                new_gcode = extra_move + new_gcode
+
+            if new_gcode != gcode_layer[line_start:line_end]:
+                append_patch(layer, line_start, line_end, new_gcode)
+
+        if input_records is not None:
+            flags = (PRIME_INDEX_RETRACTION if retraction else 0) | (PRIME_INDEX_HAS_POINT if has_point else 0)
+            input_records += pack_prime_index_record(flags, layer, line_start, e_start, e_end, line_end, travel, e, template is not None)
+
+        last_e = e
+
+    if budget is not None:
+        budget.set_memory("patches", len(patches) * PATCH_MEMORY)
+        budget.check()
+    return patches
+
+
+def apply_gcode_patches(gcode_layers:[str], patches:GCodePatchList, budget:Budget=None)->[str]:
+    if budget is not None:
+        budget.set_memory("scans", 0)
+    output_bytes = 0
+    for layer, pieces in iterate_patched_layers(gcode_layers, patches):
+        gcode_layers[layer] = "".join(pieces)
+        if budget is not None:
+            output_bytes += len(gcode_layers[layer])
+            budget.set_memory("output", output_bytes)
+            budget.set_memory("pieces", len(pieces) * PIECE_MEMORY)
+            budget.check()
+    if budget is not None:
+        budget.set_memory("pieces", 0)
     return gcode_layers
 
 
+def write_patched_gcode(gcode_layers:[str], patches:GCodePatchList, stream):
+    patched_layers = iterate_patched_layers(gcode_layers, patches)
+    next_patched = next(patched_layers, None)
+    for layer, gcode_layer in enumerate(gcode_layers):
+        if next_patched is not None and next_patched[0] == layer:
+            for piece in next_patched[1]:
+                stream.write(piece)
+            next_patched = next(patched_layers, None)
+        else:
+            stream.write(gcode_layer)
+
+
+def iterate_patched_layers(gcode_layers:[str], patches:GCodePatchList):
+    #Yields (layer, pieces) for every layer that has patches, where joining pieces gives the patched layer
+    layers, starts, ends, values, texts = patches.layers, patches.starts, patches.ends, patches.values, patches.texts
+    num_patches = len(patches)
+    patch_nr = 0
+    while patch_nr < num_patches:
+        layer = layers[patch_nr]
+        gcode_layer = gcode_layers[layer]
+        pieces = []
+        position = 0
+        while patch_nr < num_patches and layers[patch_nr] == layer:
+            pieces.append(gcode_layer[position:starts[patch_nr]])
+            text = texts.get(patch_nr)
+            pieces.append(str(values[patch_nr]) if text is None else text)
+            position = ends[patch_nr]
+            patch_nr += 1
+        pieces.append(gcode_layer[position:])
+        yield layer, pieces
+
+
+class PrimeIndex:
+    """Prime sites read back from a sidecar written by save_prime_index.
+
+    Records are unpacked straight from a read-only memory map as they are iterated, so no gcode is tokenized except for
+    the rare lines that need a template. Use as a context manager, or call close() when done.
+    """
+    def __init__(self, index_file, index_map, num_records:int, gcode_layers:[str]):
+        self._file = index_file
+        self._map = index_map
+        self._num_records = num_records
+        self._gcode_layers = gcode_layers
+
+    def __len__(self):
+        return self._num_records
+
+    def __iter__(self):
+        # Yields the sites as plain tuples with the fields of PrimeSite, like get_prime_sites
+        index_map = self._map
+        gcode_layers = self._gcode_layers
+        unpack_record = PRIME_INDEX_RECORD.unpack_from
+        records_end = PRIME_INDEX_HEADER.size + self._num_records * PRIME_INDEX_RECORD.size
+        for record_offset in range(PRIME_INDEX_HEADER.size, records_end, PRIME_INDEX_RECORD.size):
+            flags, layer, line_start, line_end, e_offset, e_length, travel, e = unpack_record(index_map, record_offset)
+            if flags & PRIME_INDEX_RESET:
+                yield (EVENT_RESET, layer, 0, 0, 0, 0, 0, False, False, e, None)
+            elif flags & PRIME_INDEX_TEMPLATE:
+                template = get_template_from_split(split_gcode(gcode_layers[layer][line_start:line_end]))
+                yield (EVENT_EXTRUDE, layer, line_start, line_start, line_start, line_end, travel, bool(flags & PRIME_INDEX_RETRACTION), bool(flags & PRIME_INDEX_HAS_POINT), e, template)
+            else:
+                e_start = line_start + e_offset
+                yield (EVENT_EXTRUDE, layer, line_start, e_start, e_start + e_length, line_end, travel, bool(flags & PRIME_INDEX_RETRACTION), bool(flags & PRIME_INDEX_HAS_POINT), e, None)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def pack_prime_index_record(flags:int, layer:int, line_start:int, e_start:int, e_end:int, line_end:int, travel:float, e:float, needs_template:bool)->bytes:
+    e_offset = e_start - line_start
+    e_length = e_end - e_start
+    # An E value too far into the line for the record is found again by tokenizing the line
+    if needs_template or e_offset > 0xffff or e_length > 0xff:
+        flags |= PRIME_INDEX_TEMPLATE
+        e_offset = e_length = 0
+    return PRIME_INDEX_RECORD.pack(flags, layer, line_start, line_end, e_offset, e_length, travel, e)
+
+
+def get_gcode_hash(gcode_layers:[str], budget:Budget=None)->bytes:
+    # Only covers the layers the adjuster processes, so changes to the header (such as the processed marker) don't matter
+    gcode_hash = hashlib.sha256()
+    gcode_hash.update(struct.pack("<Q", len(gcode_layers)))
+    for gcode_layer in gcode_layers[2:-1]:
+        if budget is not None:
+            budget.check()
+        encoded_layer = gcode_layer.encode("utf-8")
+        gcode_hash.update(struct.pack("<Q", len(encoded_layer)))
+        gcode_hash.update(encoded_layer)
+    return gcode_hash.digest()
+
+
+def get_prime_index_path(index_directory:str, gcode_hash:bytes)->str:
+    return os.path.join(index_directory, gcode_hash.hex() + PRIME_INDEX_SUFFIX)
+
+
+def save_prime_index(index_path:str, gcode_hash:bytes, records:bytes):
+    # Writes to a temporary file first, so an interrupted write never leaves a truncated index behind
+    temporary_path = index_path + ".tmp"
+    with open(temporary_path, "wb") as index_file:
+        index_file.write(PRIME_INDEX_HEADER.pack(PRIME_INDEX_MAGIC, gcode_hash, len(records) // PRIME_INDEX_RECORD.size))
+        index_file.write(records)
+    os.replace(temporary_path, index_path)
+
+
+def load_prime_index(index_path:str, gcode_layers:[str], gcode_hash:bytes=None)->PrimeIndex:
+    # Returns None if there is no usable index for exactly this gcode. Pass gcode_hash if it is known already
+    try:
+        index_file = open(index_path, "rb")
+    except OSError:
+        return None
+
+    try:
+        index_map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        index_file.close()
+        return None
+
+    if len(index_map) >= PRIME_INDEX_HEADER.size:
+        magic, index_hash, num_records = PRIME_INDEX_HEADER.unpack_from(index_map, 0)
+        if gcode_hash is None:
+            gcode_hash = get_gcode_hash(gcode_layers)
+        expected_size = PRIME_INDEX_HEADER.size + num_records * PRIME_INDEX_RECORD.size
+        if magic == PRIME_INDEX_MAGIC and len(index_map) == expected_size and index_hash == gcode_hash:
+            try:
+                os.utime(index_path)
+            except OSError:
+                pass
+            return PrimeIndex(index_file, index_map, num_records, gcode_layers)
+
+    index_map.close()
+    index_file.close()
+    return None
+
+
+def prune_prime_indexes(index_directory:str, max_bytes:int=PRIME_INDEX_MAX_BYTES):
+    # Removes the least recently used sidecars until the rest fit in max_bytes, loading a sidecar marks it as used. Also
+    # removes temporary files left over from interrupted writes
+    now = time.time()
+    index_files = []
+    for name in os.listdir(index_directory):
+        path = os.path.join(index_directory, name)
+        if name.endswith(PRIME_INDEX_SUFFIX):
+            index_stat = os.stat(path)
+            index_files.append((index_stat.st_mtime, index_stat.st_size, path))
+        elif name.endswith(PRIME_INDEX_SUFFIX + ".tmp") and now - os.path.getmtime(path) > PRIME_INDEX_STALE_SECONDS:
+            os.remove(path)
+
+    total_bytes = 0
+    for _, size, path in sorted(index_files, reverse=True):
+        total_bytes += size
+        if total_bytes > max_bytes:
+            os.remove(path)
+
+
+def select_engine(gcode_layers:[str], calibration_path:str=None, calibration:Calibration=None, budget:Budget=None, parallel:bool=False)->EngineChoice:
+    # Picks the engine and worker count with the lowest estimated run time for this job. The parallel engine is only
+    # considered if parallel is True. Only enable it where spawned worker processes can import this module and don't
+    # start the host application again, which is not the case inside Cura
+    if not parallel:
+        return EngineChoice(ENGINE_SERIAL, 1, "parallel engine is not enabled", None)
+
+    processed_layers = gcode_layers[2:-1]
+    num_layers = len(processed_layers)
+    num_bytes = sum(len(gcode_layer) for gcode_layer in processed_layers)
+
+    if num_bytes < MIN_PARALLEL_BYTES or num_layers < 2:
+        return EngineChoice(ENGINE_SERIAL, 1, "job is small ({} layers, {} bytes)".format(num_layers, num_bytes), None)
+
+    max_workers = min(os.cpu_count() or 1, num_layers)
+    if max_workers < 2:
+        return EngineChoice(ENGINE_SERIAL, 1, "only one cpu core available", None)
+
+    if calibration is None:
+        try:
+            calibration = get_calibration(calibration_path, budget)
+        except BudgetExceeded:
+            return EngineChoice(ENGINE_SERIAL, 1, "calibration did not finish within the time budget", None)
+        except Exception as e:
+            return EngineChoice(ENGINE_SERIAL, 1, "process pool failed during calibration ({})".format(e), None)
+    if calibration.pool_startup_seconds is None:
+        return EngineChoice(ENGINE_SERIAL, 1, "process pool is not available", estimate_engine_seconds(calibration, num_bytes, 1))
+
+    serial_seconds = estimate_engine_seconds(calibration, num_bytes, 1)
+    best_workers = 1
+    best_seconds = serial_seconds
+    for workers in range(2, max_workers + 1):
+        seconds = estimate_engine_seconds(calibration, num_bytes, workers)
+        if seconds < best_seconds:
+            best_workers, best_seconds = workers, seconds
+
+    if best_workers == 1:
+        return EngineChoice(ENGINE_SERIAL, 1, "estimated {:.3f}s serial, pool startup outweighs gains ({} layers, {} bytes)".format(serial_seconds, num_layers, num_bytes), serial_seconds)
+    return EngineChoice(ENGINE_PARALLEL, best_workers, "estimated {:.3f}s with {} workers vs {:.3f}s serial ({} layers, {} bytes)".format(best_seconds, best_workers, serial_seconds, num_layers, num_bytes), best_seconds)
+
+
+def estimate_engine_seconds(calibration:Calibration, num_bytes:int, workers:int)->float:
+    if workers <= 1:
+        return num_bytes * (calibration.scan_seconds_per_byte + calibration.fold_seconds_per_byte)
+    return (calibration.pool_startup_seconds * workers
+            + num_bytes * (calibration.scan_seconds_per_byte / workers + calibration.pool_seconds_per_byte + calibration.fold_seconds_per_byte))
+
+
+def get_calibration(calibration_path:str=None, budget:Budget=None)->Calibration:
+    # Runs the calibration benchmark once, and caches the result in memory and, if a path is given, on disk. A calibration
+    # that fails raises, and is not cached, so it is tried again next time
+    global _calibration
+    if _calibration is not None:
+        return _calibration
+
+    key = get_calibration_key()
+    if calibration_path:
+        try:
+            with open(calibration_path) as calibration_file:
+                stored = json.load(calibration_file)
+            if stored.get("key") == key:
+                _calibration = Calibration(*stored["calibration"])
+                return _calibration
+        except (OSError, ValueError, TypeError, KeyError):
+            pass
+
+    _calibration = run_calibration(budget)
+
+    if calibration_path:
+        try:
+            with open(calibration_path, "w") as calibration_file:
+                json.dump({"key": key, "calibration": list(_calibration)}, calibration_file)
+        except OSError:
+            pass
+    return _calibration
+
+
+def get_calibration_key()->str:
+    return "{}|{}|{}|{}".format(CALIBRATION_VERSION, platform.python_version(), platform.machine(), os.cpu_count())
+
+
+def run_calibration(budget:Budget=None)->Calibration:
+    # Raises BudgetExceeded if the budget runs out first, and the error if the process pool fails. Neither result may be
+    # cached
+    if budget is not None:
+        budget.check()
+
+    calibration_layers = ["", ""] + [get_calibration_layer(layer) for layer in range(CALIBRATION_LAYERS)] + [""]
+    layer_texts = calibration_layers[2:-1]
+    num_bytes = sum(len(gcode_layer) for gcode_layer in layer_texts)
+
+    # Like the pool below, the serial engine is timed on a second, warm pass
+    for _ in range(2):
+        start = time.perf_counter()
+        scans = list(map(scan_gcode_layer, layer_texts))
+        scan_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        get_patches_from_scans(calibration_layers, zip(range(2, len(calibration_layers) - 1), scans), 0, 200, 0, 2)
+        fold_seconds = time.perf_counter() - start
+
+    if budget is not None:
+        budget.check()
+
+    pool_startup_seconds = None
+    pool_seconds_per_byte = 0
+    # A frozen build would re-launch the whole application for every worker process
+    if not getattr(sys, "frozen", False):
+        executor = None
+        futures = []
+        try:
+            # Workers are only started when tasks are waiting, so keep them all busy at once to start every one of them
+            start = time.perf_counter()
+            executor = create_process_pool(CALIBRATION_WORKERS)
+            futures = [executor.submit(time.sleep, CALIBRATION_WARM_UP_SECONDS) for _ in range(CALIBRATION_WORKERS)]
+            for future in futures:
+                wait_for_calibration(future, budget)
+            pool_startup_seconds = max(0, time.perf_counter() - start - CALIBRATION_WARM_UP_SECONDS) / CALIBRATION_WORKERS
+
+            # The first batch still pays for warming up the workers, only the second one is timed
+            for _ in range(2):
+                start = time.perf_counter()
+                futures = [executor.submit(scan_gcode_layer, gcode_layer) for gcode_layer in layer_texts]
+                for future in futures:
+                    wait_for_calibration(future, budget)
+            concurrent_workers = min(CALIBRATION_WORKERS, os.cpu_count() or 1)
+            pool_seconds_per_byte = max(0, time.perf_counter() - start - scan_seconds / concurrent_workers) / num_bytes
+        finally:
+            if executor is not None:
+                shutdown_process_pool(executor, futures)
+
+    return Calibration(scan_seconds / num_bytes, fold_seconds / num_bytes, pool_startup_seconds, pool_seconds_per_byte)
+
+
+def wait_for_calibration(future, budget:Budget=None):
+    remaining = None if budget is None else budget.remaining()
+    if remaining is not None and remaining < CALIBRATION_TIMEOUT:
+        try:
+            return future.result(timeout=remaining)
+        except TimeoutError:
+            raise BudgetExceeded("time budget of {}s exceeded".format(budget.seconds))
+    return future.result(timeout=CALIBRATION_TIMEOUT)
+
+
+def get_calibration_layer(layer:int)->str:
+    lines = []
+    e = layer * 100.0
+    for line_nr in range(CALIBRATION_LAYER_LINES):
+        x = (line_nr * 7 % 200) / 2
+        y = (line_nr * 13 % 200) / 2
+        if line_nr % 10 == 0:
+            lines.append("G1 F1500 E{:.5f}".format(e - 1))
+            lines.append("G0 F7200 X{:.3f} Y{:.3f}".format(x, y))
+            lines.append("G1 F1500 E{:.5f}".format(e))
+        else:
+            e += 0.03
+            lines.append("G1 X{:.3f} Y{:.3f} E{:.5f}".format(x, y, e))
+    return "\n".join(lines) + "\n"
+
+
 def get_extra_e(min_travel:float, max_travel:float, min_prime:float, max_prime:float, actual_travel:float)->float:
 
     #If we didn't travel at least the min distance, return 0 extra e
@@ -173,6 +887,34 @@ def combine_gcode(args:[GCodeArg], comment:str=None)-> [str]:
     return gcode_line;
 
 
+def split_canonical_gcode(g_command:str)->[(str, str)]:
+    # Splits lines that combine_gcode would give back unchanged, which is almost every line a slicer writes, into the
+    # same arguments as split_gcode, but as plain tuples. Returns None for any other line.
+    if len(g_command) != len(g_command.strip()):
+        return None
+    if ';' in g_command:
+        comment_index = g_command.find(';')
+        if comment_index > 0 and g_command[comment_index-1] != " ":
+            return None
+    args = g_command.split(" ")
+    parsed = [(arg[0], arg[1:]) for arg in args if len(arg) > 1]
+    if len(parsed) != len(args):
+        return None
+    return parsed
+
+
+def get_template_from_split(args:[GCodeArg])->str:
+    placeholder_arg = GCodeArg("E", E_PLACEHOLDER)
+    return combine_gcode([placeholder_arg if arg.name == "E" else arg for arg in args])
+
+
+def combine_template(template:str, e_value:float, comment:str=None)->str:
+    gcode_line = template.replace(E_PLACEHOLDER, str(round(e_value, 5)))
+    if comment:
+        gcode_line += " ;" + comment
+    return gcode_line
+
+
 def get_point_from_split(args:[GCodeArg])->Point:
     x = None;
     y = None;
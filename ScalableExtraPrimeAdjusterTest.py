@@ -1,7 +1,12 @@
 # Copyright (c) 2018 Pheneeny
 # The ScalableExtraPrime plugin is released under the terms of the AGPLv3 or higher.
 
+import io
+import os
+import tempfile
+import time
 import unittest
+from unittest import mock
 import ScalableExtraPrimeAdjuster as lepa
 
 gcode1 = "G1 X82.559 Y142.583 E510.05313"
@@ -272,6 +277,189 @@ G1 E-2 F300
         self.assertEqual(expected_output, output[2])
         self.assertEqual(last_layer, output[3])
 
+    def test_get_gcode_patches(self):
+        gcode = '''G1 X10.00 Y0.00 E2.0
+G0 F7200 X0.00 Y0.00
+G1 X10.00 Y0.00 E4.0
+'''
+        patches = lepa.get_gcode_patches(["", "", gcode, ""], 0, 200, 0, 2)
+        self.assertEqual(2, len(patches))
+        self.assertEqual([2, 2], list(patches.layers))
+        line_start = gcode.index("G1 X10.00 Y0.00 E4.0")
+        self.assertEqual((line_start, line_start), (patches.starts[0], patches.ends[0]))
+        self.assertEqual("G1 E2.1 ;Adjusted e by 0.1mm\n", patches.get_replacement(0))
+        self.assertEqual("4.0", gcode[patches.starts[1]:patches.ends[1]])
+        self.assertEqual("4.1", patches.get_replacement(1))
+
+    def test_split_canonical_gcode(self):
+        self.assertEqual(lepa.split_gcode(gcode1), lepa.split_canonical_gcode(gcode1))
+        self.assertEqual(lepa.split_gcode(gcode4), lepa.split_canonical_gcode(gcode4))
+        for line in ["G1  X1 E2", "G1 X1 E2 ", "G1 X1 E2\r", "G1 X1 E2;comment", "G1 X1 E2 ;"]:
+            self.assertIsNone(lepa.split_canonical_gcode(line), line)
+
+    def test_write_patched_gcode(self):
+        gcode = '''G1 X10.00 Y0.00 E2.00
+G1 X10.000 Y10.00 E4.00
+G1 F1500 E3.5
+G0 F7200 X0.00 Y10.00
+G0 F7200 X0.00 Y0.00
+G1 E4.00
+G1 X10.00 Y0.00 E6.00
+'''
+        gcode_layers = [";header\n", ";start\n", gcode, gcode, ";end\n"]
+        patches = lepa.get_gcode_patches(gcode_layers, 0, 200, 0, 2)
+        stream = io.StringIO()
+        lepa.write_patched_gcode(gcode_layers, patches, stream)
+        expected_output = "".join(lepa.parse_and_adjust_gcode(list(gcode_layers), 0, 200, 0, 2))
+        self.assertEqual(expected_output, stream.getvalue())
+
+    def test_parse_gcode_parallel(self):
+        gcode_layers = ["", ""] + [lepa.get_calibration_layer(layer) for layer in range(4)] + [""]
+        expected_output = lepa.parse_and_adjust_gcode(list(gcode_layers), 0, 200, 0, 2)
+        with mock.patch.object(lepa, "POOL_CHUNK_BYTES", 1):
+            output = lepa.parse_and_adjust_gcode(list(gcode_layers), 0, 200, 0, 2, True, 2)
+        self.assertEqual(expected_output, output)
+
+    def test_get_layer_chunks(self):
+        gcode_layers = ["", "", "a" * 10, "b" * 10, "c" * 25, "d" * 5, ""]
+        with mock.patch.object(lepa, "POOL_CHUNK_BYTES", 20):
+            self.assertEqual([range(2, 4), range(4, 5), range(5, 6)], lepa.get_layer_chunks(gcode_layers, range(2, 6)))
+
+    def test_select_engine(self):
+        calibration = lepa.Calibration(1e-7, 1e-8, 0.05, 1e-9)
+        small_layers = ["", "", "G1 X1 Y1 E1\n", ""]
+        large_layers = ["", ""] + ["G1 X1 Y1 E1\n" * 100000] * 40 + [""]
+        with mock.patch("os.cpu_count", return_value=4):
+            self.assertEqual(lepa.ENGINE_SERIAL, lepa.select_engine(large_layers, calibration=calibration).engine)
+            self.assertEqual(lepa.ENGINE_SERIAL, lepa.select_engine(small_layers, calibration=calibration, parallel=True).engine)
+            choice = lepa.select_engine(large_layers, calibration=calibration, parallel=True)
+            self.assertEqual(lepa.ENGINE_PARALLEL, choice.engine)
+            self.assertEqual(4, choice.workers)
+
+            no_pool = lepa.Calibration(1e-7, 1e-8, None, 0)
+            self.assertEqual(lepa.ENGINE_SERIAL, lepa.select_engine(large_layers, calibration=no_pool, parallel=True).engine)
+
+    def test_select_engine_calibration_budget(self):
+        large_layers = ["", ""] + ["G1 X1 Y1 E1\n" * 100000] * 40 + [""]
+        with mock.patch("os.cpu_count", return_value=4), mock.patch.object(lepa, "_calibration", None):
+            choice = lepa.select_engine(large_layers, budget=lepa.Budget(0), parallel=True)
+            self.assertEqual(lepa.ENGINE_SERIAL, choice.engine)
+            self.assertIn("calibration", choice.reason)
+            self.assertIsNone(lepa._calibration)
+
+    def test_calibration_cache(self):
+        calibration = lepa.Calibration(1e-7, 1e-8, 0.05, 1e-9)
+        with tempfile.TemporaryDirectory() as directory:
+            calibration_path = os.path.join(directory, "calibration.json")
+            with mock.patch.object(lepa, "_calibration", None), mock.patch.object(lepa, "run_calibration", return_value=calibration):
+                self.assertEqual(calibration, lepa.get_calibration(calibration_path))
+            with mock.patch.object(lepa, "_calibration", None), mock.patch.object(lepa, "run_calibration") as run_calibration:
+                self.assertEqual(calibration, lepa.get_calibration(calibration_path))
+                run_calibration.assert_not_called()
+
+    def test_failed_calibration_is_not_cached(self):
+        large_layers = ["", ""] + ["G1 X1 Y1 E1\n" * 100000] * 40 + [""]
+        with tempfile.TemporaryDirectory() as directory:
+            calibration_path = os.path.join(directory, "calibration.json")
+            with mock.patch("os.cpu_count", return_value=4), mock.patch.object(lepa, "_calibration", None), \
+                    mock.patch.object(lepa, "run_calibration", side_effect=lepa.TimeoutError()):
+                choice = lepa.select_engine(large_layers, calibration_path, parallel=True)
+                self.assertEqual(lepa.ENGINE_SERIAL, choice.engine)
+                self.assertIn("calibration", choice.reason)
+                self.assertIsNone(lepa._calibration)
+            self.assertFalse(os.path.exists(calibration_path))
+
+    def test_adjust_gcode_copy_on_write(self):
+        gcode_layers = [";header\n", ";start\n", "G1 X10 Y0 E2\nG0 X0 Y0\nG1 X10 Y0 E4\n", ";unchanged\n", ";end\n"]
+        original_layers = list(gcode_layers)
+        output, warning = lepa.adjust_gcode(gcode_layers, 0, 200, 0, 2)
+        self.assertIsNone(warning)
+        self.assertEqual(original_layers, gcode_layers)
+        self.assertEqual(lepa.parse_and_adjust_gcode(list(gcode_layers), 0, 200, 0, 2), output)
+        self.assertIs(gcode_layers[3], output[3])
+
+    def test_adjust_gcode_returns_original_on_error(self):
+        gcode_layers = ["", "", "G1 X10 Y0 E2\nG0 X0 Y0\nG1 X10 Y0 E4\n", "M83\nG1 X10 Y0 E4\n", "", ""]
+        output, warning = lepa.adjust_gcode(gcode_layers, 0, 200, 0, 2)
+        self.assertIs(gcode_layers, output)
+        self.assertIn("M83", warning)
+
+    def test_adjust_gcode_budget(self):
+        gcode_layers = ["", "", "G1 X10 Y0 E2\nG0 X0 Y0\nG1 X10 Y0 E4\n", ""]
+
+        output, warning = lepa.adjust_gcode(gcode_layers, 0, 200, 0, 2, budget=lepa.Budget(0))
+        self.assertIs(gcode_layers, output)
+        self.assertIn("time budget", warning)
+
+        output, warning = lepa.adjust_gcode(gcode_layers, 0, 200, 0, 2, budget=lepa.Budget(None, 10))
+        self.assertIs(gcode_layers, output)
+        self.assertIn("memory budget", warning)
+
+        # A slow estimate never refuses a plate up front, only the work itself is bounded
+        engine = lepa.EngineChoice(lepa.ENGINE_SERIAL, 1, "", 120)
+        output, warning = lepa.adjust_gcode(gcode_layers, 0, 200, 0, 2, engine=engine, budget=lepa.Budget(60))
+        self.assertIsNone(warning)
+        self.assertEqual(lepa.parse_and_adjust_gcode(list(gcode_layers), 0, 200, 0, 2), output)
+
+    def test_adjust_gcode_pool_failure_falls_back_to_serial(self):
+        gcode_layers = ["", "", "G1 X10 Y0 E2\nG0 X0 Y0\n", "G1 X10 Y0 E4\n", ""]
+        engine = lepa.EngineChoice(lepa.ENGINE_PARALLEL, 2, "", None)
+        with mock.patch.object(lepa, "scan_gcode_layers_in_pool", side_effect=lepa.BrokenProcessPool()):
+            output, warning = lepa.adjust_gcode(gcode_layers, 0, 200, 0, 2, engine=engine)
+        self.assertIsNone(warning)
+        self.assertEqual(lepa.parse_and_adjust_gcode(list(gcode_layers), 0, 200, 0, 2), output)
+
+    def test_prime_index(self):
+        gcode_layers = ["", "", "G1 X10 Y0 E2\nG1 F1500 E1.5\nG0 X0 Y0\nG1 E2\nG92 E0\n", "G0 X0 Y10\nG1  X10 Y0 E4 ;wall\n", ""]
+        with tempfile.TemporaryDirectory() as index_directory:
+            output, warning = lepa.adjust_gcode(gcode_layers, 0, 200, 0, 2, index_directory=index_directory)
+            self.assertIsNone(warning)
+            self.assertEqual(lepa.parse_and_adjust_gcode(list(gcode_layers), 0, 200, 0, 2), output)
+
+            index_path = lepa.get_prime_index_path(index_directory, lepa.get_gcode_hash(gcode_layers))
+            self.assertEqual([os.path.basename(index_path)], os.listdir(index_directory))
+            self.assertEqual(lepa.PRIME_INDEX_HEADER.size + 5 * lepa.PRIME_INDEX_RECORD.size, os.path.getsize(index_path))
+            self.assertIsNone(lepa.load_prime_index(index_path, output))
+
+            with lepa.load_prime_index(index_path, gcode_layers) as prime_index:
+                sites = [lepa.PrimeSite(*site) for site in prime_index]
+            self.assertEqual(lepa.EVENT_RESET, sites[3].kind)
+            self.assertEqual((lepa.EVENT_EXTRUDE, 2, 10, True, False, 2), (sites[2].kind, sites[2].layer, sites[2].travel, sites[2].retraction, sites[2].has_point, sites[2].e))
+            self.assertEqual("2", gcode_layers[2][sites[2].e_start:sites[2].e_end])
+            self.assertEqual("G1 X10 Y0 E\0 ;wall", sites[4].template)
+
+            # A sidecar hit gives exactly what a scan gives, for the sliced gcode as well as for output run again
+            expected_output, _ = lepa.adjust_gcode(gcode_layers, 0, 100, 0.5, 1)
+            expected_rerun, _ = lepa.adjust_gcode(output, 0, 100, 0.5, 1)
+            rerun, warning = lepa.adjust_gcode(output, 0, 100, 0.5, 1, index_directory=index_directory)
+            self.assertEqual(expected_rerun, rerun)
+            with mock.patch.object(lepa, "scan_gcode_layer") as scan_gcode_layer, mock.patch.object(lepa, "select_engine") as select_engine:
+                resliced_output, warning = lepa.adjust_gcode(list(gcode_layers), 0, 100, 0.5, 1, index_directory=index_directory)
+                self.assertIsNone(warning)
+                reused_rerun, warning = lepa.adjust_gcode(output, 0, 100, 0.5, 1, index_directory=index_directory)
+                self.assertIsNone(warning)
+                scan_gcode_layer.assert_not_called()
+                select_engine.assert_not_called()
+            self.assertEqual(expected_output, resliced_output)
+            self.assertEqual(expected_rerun, reused_rerun)
+
+    def test_prune_prime_indexes(self):
+        with tempfile.TemporaryDirectory() as index_directory:
+            def write_file(name, size, age):
+                path = os.path.join(index_directory, name)
+                with open(path, "wb") as index_file:
+                    index_file.write(b"\0" * size)
+                mtime = time.time() - age
+                os.utime(path, (mtime, mtime))
+
+            write_file("old.idx", 100, 30)
+            write_file("used.idx", 100, 20)
+            write_file("new.idx", 100, 10)
+            write_file("stale.idx.tmp", 100, lepa.PRIME_INDEX_STALE_SECONDS + 1)
+            write_file("writing.idx.tmp", 100, 0)
+            lepa.prune_prime_indexes(index_directory, 250)
+            self.assertEqual(["new.idx", "used.idx", "writing.idx.tmp"], sorted(os.listdir(index_directory)))
+
     def test_and_throw_M83(self):
         gcode = '''G1 X10.00 Y0.00 E2.00
 G1 X10.000 Y10.00 E4.00